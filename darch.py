@@ -11,21 +11,30 @@ Creates bootable disk images with:
 
 # pylint: disable=line-too-long,too-many-lines,too-many-locals
 
-from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager, ExitStack
 from dataclasses import dataclass, field
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
-from typing import Set, Dict, Tuple, Literal, Iterator
+from typing import Callable, Set, Dict, Tuple, Literal, Iterator
 import argparse
+import ctypes
+import errno
 import fcntl
+import functools
 import importlib.util
 import json
 import os
 import re
+import shlex
 import shutil
+import signal
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 
@@ -37,6 +46,9 @@ GC_KEEP_MAX = 10         # Keep at most this many generations (0 = unlimited)
 GC_MIN_AGE_DAYS = 7      # Never delete generations younger than this
 GC_MAX_AGE_DAYS = 30     # Delete generations older than this (0 = keep forever)
 
+# Used by pacstrap if the host's pacman.conf doesn't set ParallelDownloads itself
+PACSTRAP_PARALLEL_DOWNLOADS = 10
+
 
 class CriticalError(Exception):
     """Error which should be propagated all the way out of main()
@@ -136,6 +148,13 @@ class ConfigDiff:
     @classmethod
     def compute(cls, old: Config, new: Config) -> ConfigDiff:
         """Compare two configs and return the differences."""
+        # Common case of an unchanged config: plain field comparisons, no per-key work.
+        # (Not old == new: the configs may come from different modules, __main__ and
+        # darch, and dataclass equality is False across classes.)
+        if (old.packages == new.packages and old.files == new.files
+                and old.initramfs_modules == new.initramfs_modules
+                and [u.to_dict() for u in old.users] == [u.to_dict() for u in new.users]):
+            return cls(set(), set(), {}, {}, {}, user_accounts_changed=False, user_files_changed=False)
         old_accounts = json.dumps([u.account_dict() for u in old.users], sort_keys=True)
         new_accounts = json.dumps([u.account_dict() for u in new.users], sort_keys=True)
         old_files = json.dumps([u.files for u in old.users], sort_keys=True)
@@ -221,6 +240,10 @@ class Config:
     # Users
     users: list[User] = field(default_factory=list)
 
+    # Memoized sorted package/module lists: name -> (snapshot of set, sorted tuple)
+    _sorted_cache: Dict[str, Tuple[frozenset[str], Tuple[str, ...]]] = field(
+        default_factory=dict, init=False, repr=False, compare=False)
+
     # -------------------------------------------------------------------------
     # Builder methods
     # -------------------------------------------------------------------------
@@ -228,6 +251,7 @@ class Config:
     def add_packages(self, *names: str) -> Config:
         """Add packages to install."""
         self.packages.update(names)
+        self._sorted_cache.pop("packages", None)
         return self
 
     def enable_qemu_testing(self):
@@ -292,6 +316,22 @@ class Config:
     # Serialization
     # -------------------------------------------------------------------------
 
+    def _sorted(self, name: str, items: Set[str]) -> Tuple[str, ...]:
+        """Sorted tuple of a set field, re-sorted only if the set changed since last time.
+
+        The sets are public and may be mutated directly, so the cache is validated
+        against a snapshot (an O(n) comparison instead of an O(n log n) sort).
+        """
+        cached = self._sorted_cache.get(name)
+        if cached is None or cached[0] != items:
+            cached = (frozenset(items), tuple(sorted(items)))
+            self._sorted_cache[name] = cached
+        return cached[1]
+
+    def sorted_packages(self) -> Tuple[str, ...]:
+        """Packages in sorted order (memoized), for stable command lines and listings."""
+        return self._sorted("packages", self.packages)
+
     def to_dict(self) -> dict:
         """Serialize config to a dict (for JSON storage)."""
         # Convert files dict: tuples to lists for JSON
@@ -299,9 +339,9 @@ class Config:
         for path, entry in self.files.items():
             files_serialized[path] = list(entry)
         return {
-            "packages": sorted(self.packages),
+            "packages": list(self.sorted_packages()),
             "files": files_serialized,
-            "initramfs_modules": sorted(self.initramfs_modules),
+            "initramfs_modules": list(self._sorted("initramfs_modules", self.initramfs_modules)),
             "users": [u.to_dict() for u in self.users],
         }
 
@@ -378,9 +418,7 @@ COMPRESSION="zstd"
 """
 
 
-def generate_darch_hook_runtime() -> str:
-    """Generate the darch initcpio runtime hook."""
-    return r'''#!/usr/bin/ash
+DARCH_HOOK_RUNTIME = r'''#!/usr/bin/ash
 # darch initcpio runtime hook
 # Sets up tmpfs root with symlinks to generation
 
@@ -399,8 +437,9 @@ darch_mount_handler() {
     echo ":: darch: Parsing kernel cmdline..."
 
     # Parse kernel command line
-    local root_uuid="" gen=""
-    for param in $(cat /proc/cmdline); do
+    local root_uuid="" gen="" cmdline param
+    read -r cmdline </proc/cmdline  # shell builtin, no cat fork
+    for param in $cmdline; do
         case "$param" in
             root=UUID=*)
                 root_uuid="${param#root=UUID=}"
@@ -446,16 +485,8 @@ darch_mount_handler() {
 
     # Create directory structure
     echo ":: darch: Creating directory structure..."
-    mkdir -p "$newroot/dev"
-    mkdir -p "$newroot/proc"
-    mkdir -p "$newroot/sys"
-    mkdir -p "$newroot/run"
-    mkdir -p "$newroot/tmp"
-    mkdir -p "$newroot/mnt"
-    mkdir -p "$newroot/efi"
-    mkdir -p "$newroot/images"
-    mkdir -p "$newroot/var"
-    mkdir -p "$newroot/home"
+    mkdir -p "$newroot/dev" "$newroot/proc" "$newroot/sys" "$newroot/run" "$newroot/tmp" \
+        "$newroot/mnt" "$newroot/efi" "$newroot/images" "$newroot/var" "$newroot/home"
     chmod 1777 "$newroot/tmp"
 
     # Mount btrfs subvolumes
@@ -472,31 +503,29 @@ darch_mount_handler() {
 
     # Create symlinks to generation (relative paths so they work before switch_root)
     echo ":: darch: Creating symlinks to gen-$gen..."
-    ln -s "images/gen-$gen" "$newroot/current"
-    ln -s current/usr "$newroot/usr"
-    ln -s current/etc "$newroot/etc"
-    ln -s current/boot "$newroot/boot"
-
-    # Standard symlinks (relative)
-    ln -s usr/bin "$newroot/bin"
-    ln -s usr/lib "$newroot/lib"
-    ln -s usr/lib "$newroot/lib64"
-    ln -s usr/bin "$newroot/sbin"
-
-    # Root home - symlink to persistent home (relative)
-    ln -s home/root "$newroot/root"
-
-    # /init - point to systemd (relative path through symlink chain)
-    ln -s usr/lib/systemd/systemd "$newroot/init"
+    # Each line is "<name> <target>": the generation, standard symlinks, root's home
+    # (persistent), and /init pointing to systemd through the symlink chain
+    local name target
+    while read -r name target; do
+        ln -s "$target" "$newroot/$name"
+    done <<LINKS
+current images/gen-$gen
+usr current/usr
+etc current/etc
+boot current/boot
+bin usr/bin
+lib usr/lib
+lib64 usr/lib
+sbin usr/bin
+root home/root
+init usr/lib/systemd/systemd
+LINKS
 
     echo ":: darch: tmpfs root setup complete!"
 }
 '''
 
-
-def generate_darch_hook_install() -> str:
-    """Generate the darch initcpio install hook."""
-    return r'''#!/usr/bin/bash
+DARCH_HOOK_INSTALL = r'''#!/usr/bin/bash
 # darch initcpio install hook
 
 build() {
@@ -511,6 +540,16 @@ HELPEOF
 '''
 
 
+def generate_darch_hook_runtime() -> str:
+    """Generate the darch initcpio runtime hook."""
+    return DARCH_HOOK_RUNTIME
+
+
+def generate_darch_hook_install() -> str:
+    """Generate the darch initcpio install hook."""
+    return DARCH_HOOK_INSTALL
+
+
 def generate_fstab(esp_uuid: str, root_uuid: str) -> str:
     """Generate /etc/fstab content."""
     return f"""# /etc/fstab: static file system information
@@ -638,10 +677,7 @@ def configure_users(users: list[User], gen_root: Path, home_path: Path):
 
     # Write back to generation
     def write_lines(filename: str, lines: list[str], mode: int | None = None):
-        path = etc / filename
-        path.write_text("\n".join(lines) + "\n")
-        if mode:
-            path.chmod(mode)
+        atomic_write_text(etc / filename, "\n".join(lines) + "\n", mode)
 
     write_lines("passwd", passwd_lines)
     write_lines("shadow", shadow_lines, 0o600)
@@ -664,25 +700,25 @@ def write_user_home_files(users: list[User], home_path: Path):
 
         if not user.files:
             continue
+        known_dirs: set[Path] = {user_home}  # Directories known to exist, to skip re-checking
         for file_path, entry in user.files.items():
             # Expand ~/ to user's home directory
             assert file_path.startswith("~/")
             path = user_home / file_path[2:]
 
             # Create parent directories with user ownership
-            if not path.parent.exists():
+            if path.parent not in known_dirs and not path.parent.exists():
                 path.parent.mkdir(parents=True, exist_ok=True)
                 # Walk up and chown all created directories
                 for parent in [path.parent] + list(path.parent.parents):
                     if parent == user_home or not str(parent).startswith(str(user_home)):
                         break
                     os.chown(parent, user.uid, user.uid)
+            known_dirs.add(path.parent)
 
             if entry[0] == 'file':
                 content, mode = entry[1], entry[2]
-                path.write_text(content)
-                if mode is not None:
-                    path.chmod(mode)
+                atomic_write_text(path, content, mode, fsync=False)
                 os.chown(path, user.uid, user.uid)
                 print(f"  {user.name}: {file_path}")
             elif entry[0] == 'symlink':
@@ -698,19 +734,45 @@ def write_user_home_files(users: list[User], home_path: Path):
 # Build context and functions
 # =============================================================================
 
+_CLEAN_ENV: dict[str, str] | None = None
+
+
+def clean_env() -> dict[str, str]:
+    """Environment for subprocesses, computed once (never mutated, so safe to share)."""
+    global _CLEAN_ENV  # pylint: disable=global-statement
+    if _CLEAN_ENV is None:
+        # Remove locale vars to prevent host locale leaking into chroot
+        env = {k: v for k, v in os.environ.items()
+               if not k.startswith("LC_") and k not in ("LANGUAGE",)}
+        env["LC_ALL"] = "C"
+        _CLEAN_ENV = env
+    return _CLEAN_ENV
+
+
 def run(cmd, check=True, capture_output=False) -> str:
     """Run a command and optionally capture output."""
-    # Clean environment: remove locale vars to prevent host locale leaking into chroot
-    env = {k: v for k, v in os.environ.items()
-           if not k.startswith("LC_") and k not in ("LANGUAGE",)}
-    env["LC_ALL"] = "C"
+    env = clean_env()
 
     #cmd_str = ' '.join(str(c) for c in cmd)
     #print(f"Running: {cmd_str}")
     if capture_output:
         result = subprocess.run(cmd, check=check, capture_output=True, text=True, env=env)
         return result.stdout.strip()
-    subprocess.run(cmd, check=check, env=env)
+    # posix_spawn (vfork+exec in glibc) without Popen's bookkeeping, for the many short commands.
+    # Like subprocess's restore_signals, reset the signals Python ignores for itself, so
+    # pipelines in the child (pacstrap, pacman hooks) see SIGPIPE normally. No close_fds
+    # is needed: Python opens all its fds non-inheritable, so only stdio is passed on.
+    args = [os.fspath(c) for c in cmd]
+    pid = os.posix_spawnp(args[0], args, env, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    try:
+        returncode = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+    except BaseException:
+        # Like subprocess.run: don't leave the child running (e.g. under mounts being torn down)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
     return ""
 
 
@@ -719,6 +781,67 @@ def chroot_run(root: Path, *cmd, check=True, capture_output=False) -> str:
     return run(["arch-chroot", root] + list(cmd), check=check, capture_output=capture_output)
 
 
+def chroot_run_parallel(chroot: Callable[..., None], *cmds: list[str]):
+    """Run independent commands concurrently in a chroot session, failing if any fails.
+
+    The commands share one shell in the session, since concurrent arch-chroot
+    processes would race on setting up and tearing down the same API mounts.
+    """
+    lines = []
+    for i, cmd in enumerate(cmds):
+        lines.append(f"{shlex.join(cmd)} & pid{i}=$!")
+    lines.append("rc=0")
+    for i in range(len(cmds)):
+        lines.append(f"wait $pid{i} || rc=1")
+    lines.append("exit $rc")
+    chroot("/bin/sh", "-c", "\n".join(lines))
+
+
+_MOUNTS_CACHE: list[tuple[str, str, str]] | None = None
+
+
+def _unescape_mount_field(field_str: str) -> str:
+    """Decode the octal escapes (e.g. \\040 for space) used in /proc/mounts fields."""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), field_str)
+
+
+def parse_mounts() -> list[tuple[str, str, str]]:
+    """Return (device, mountpoint, fstype) for each entry in /proc/mounts, in mount order.
+
+    Device and mountpoint are unescaped, so they can be passed on to umount etc.
+    The table is cached until invalidate_mounts() is called (after every mount/umount).
+    """
+    global _MOUNTS_CACHE  # pylint: disable=global-statement
+    if _MOUNTS_CACHE is None:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            _MOUNTS_CACHE = [(_unescape_mount_field(parts[0]), _unescape_mount_field(parts[1]), parts[2])
+                             for parts in (line.split() for line in f) if len(parts) >= 3]
+    return _MOUNTS_CACHE
+
+
+def invalidate_mounts():
+    """Drop the cached mount table."""
+    global _MOUNTS_CACHE  # pylint: disable=global-statement
+    _MOUNTS_CACHE = None
+
+
+# The already loaded C library, for syncfs() (which the os module doesn't wrap)
+_LIBC = ctypes.CDLL(None, use_errno=True)
+
+
+def syncfs(path: Path):
+    """Flush only the filesystem containing path, rather than all of them like sync(1)."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _LIBC.syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+    except AttributeError:
+        os.sync()  # No syncfs available
+    finally:
+        os.close(fd)
+
+
 def fix_owner(path: Path):
     """Fix ownership of a file to the invoking user (when run via sudo)."""
     uid = os.environ.get("SUDO_UID")
@@ -727,36 +850,118 @@ def fix_owner(path: Path):
         os.chown(path, int(uid), int(gid))
 
 
-def write_config_files(root: Path, files: Dict[str, FileEntry | SymlinkEntry]) -> Set[str]:
-    """Write config files to filesystem, returning paths that were changed."""
-    changed = set()
+FileSignature = Tuple[int, int, int, int]  # (st_ino, st_size, st_mtime_ns, st_mode) from lstat
+
+
+def file_signature(path: Path) -> FileSignature | None:
+    """Cheap on-disk identity of a path (one lstat), or None if it doesn't exist."""
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+
+def write_config_files(
+    root: Path,
+    files: Dict[str, FileEntry | SymlinkEntry],
+    signatures: Dict[str, Tuple[FileEntry | SymlinkEntry, FileSignature | None]] | None = None,
+) -> Set[str]:
+    """Write config files to filesystem, returning paths that were changed.
+
+    If signatures is given, it maps paths to (entry, on-disk signature) as left by a
+    previous call; entries whose content and on-disk signature are both unchanged
+    are skipped without reading the file. It is updated with the new state.
+    """
+    pending = []
+    made_dirs: set[Path] = set()  # Parent directories already ensured in this call
     for config_path, entry in files.items():
         path = root / config_path[1:]  # strip leading /
-        path.parent.mkdir(parents=True, exist_ok=True)
-
-        # Check if file already matches
-        if entry[0] == 'file':
-            content, mode = entry[1], entry[2]
-            if path.is_file() and not path.is_symlink():
-                if path.read_text() == content and (mode is None or path.stat().st_mode & 0o777 == mode):
-                    continue
-            if path.exists() or path.is_symlink():
-                path.unlink()
-            path.write_text(content)
-            if mode is not None:
-                path.chmod(mode)
-            print(f"  file: {config_path}")
-        elif entry[0] == 'symlink':
-            target = entry[1]
-            if path.is_symlink() and os.readlink(path) == target:
+        if signatures is not None:
+            prev = signatures.get(config_path)
+            if prev is not None and prev[0] == entry and prev[1] == file_signature(path):
                 continue
-            force_symlink(path, target)
-            print(f"  symlink: {config_path}")
+        # Directories are made up front, so the writes below are independent of each other
+        if path.parent not in made_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            made_dirs.add(path.parent)
+        pending.append((config_path, path, entry))
+
+    # Each write is a handful of blocking syscalls; overlap them when there are many
+    if len(pending) > 16:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(lambda p: _write_config_file(*p[1:]), pending))
+    else:
+        results = [_write_config_file(path, entry) for _, path, entry in pending]
 
-        changed.add(config_path)
+    changed = set()
+    for (config_path, path, entry), up_to_date in zip(pending, results):
+        if not up_to_date:
+            print(f"  {entry[0]}: {config_path}")
+            changed.add(config_path)
+        if signatures is not None:
+            signatures[config_path] = (entry, file_signature(path))
     return changed
 
 
+def _write_config_file(path: Path, entry: FileEntry | SymlinkEntry) -> bool:
+    """Write one config file or symlink unless it already matches. Returns whether it did."""
+    if entry[0] == 'file':
+        data, mode = entry[1].encode(), entry[2]  # Encoded once, for both compare and write
+        try:
+            st = os.lstat(path)  # One lstat covers type, size and mode checks
+        except FileNotFoundError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode) and st.st_size == len(data):
+            if (mode is None or st.st_mode & 0o777 == mode) and path.read_bytes() == data:
+                return True
+        # No per-file fsync: the generation is flushed as a whole when unmounted
+        atomic_write_text(path, data, mode, fsync=False)
+        return False
+    if entry[0] == 'symlink':
+        target = entry[1]
+        if path.is_symlink() and os.readlink(path) == target:
+            return True
+        force_symlink(path, target)
+        return False
+    return True
+
+
+def move_tree(src: Path, dst: Path):
+    """Move a directory tree, using a reflink copy if it crosses filesystems/subvolumes."""
+    try:
+        os.rename(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        # On btrfs the copy only clones extents (metadata), not data
+        run(["cp", "-a", "--reflink=auto", src, dst])
+        shutil.rmtree(src)
+
+
+def atomic_write_text(path: Path, content: str | bytes, mode: int | None = None, fsync: bool = True):
+    """Write a file atomically: write (and fsync) a temp file, then rename it over path.
+
+    The content (str, or already encoded bytes) goes out in a single write, and the
+    mode (default 0644) is set on the open fd. The temp file gets a unique name created
+    with O_EXCL, so it never follows or clobbers an existing file (user home
+    directories are writable by their owner).
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        try:
+            os.fchmod(fd, 0o644 if mode is None else mode)
+            os.write(fd, content.encode() if isinstance(content, str) else content)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def force_symlink(path: Path, target: str):
     """Create a symlink, removing any existing file/symlink first."""
     if path.exists() or path.is_symlink():
@@ -788,37 +993,71 @@ def get_available_upgrades(mount_root: Path) -> list[str]:
 
 
 def count_packages(mount_root: Path) -> int:
-    """Count installed packages in a generation."""
-    output = chroot_run(mount_root, "pacman", "--dbpath", "/pacman", "-Q", capture_output=True)
-    return len(output.strip().split('\n')) if output.strip() else 0
+    """Count installed packages in a generation.
+
+    Equivalent to counting `pacman -Q` lines: each installed package is a directory
+    in the local database (which also holds a plain ALPM_DB_VERSION file).
+    """
+    try:
+        with os.scandir(mount_root / "pacman" / "local") as it:
+            return sum(1 for entry in it if entry.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return 0
 
 
-def build_generation(config: Config, mount_root: Path, btrfs_dev: Path):
+@contextmanager
+def pacstrap_config() -> Iterator[Path]:
+    """Yield a pacman.conf for pacstrap: the host's, with ParallelDownloads enabled if unset."""
+    host_conf = Path("/etc/pacman.conf")
+    text = host_conf.read_text(encoding="utf-8")
+    if re.search(r"^\s*ParallelDownloads\s*=", text, re.MULTILINE):
+        yield host_conf
+        return
+    text, found = re.subn(r"^\[options\][ \t]*$", f"[options]\nParallelDownloads = {PACSTRAP_PARALLEL_DOWNLOADS}",
+                          text, count=1, flags=re.MULTILINE)
+    if not found:
+        yield host_conf
+        return
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="darch-pacman-", suffix=".conf") as f:
+        f.write(text)
+        f.flush()
+        yield Path(f.name)
+
+
+# Config files which affect the initramfs
+INITRAMFS_PATHS = frozenset({"/etc/mkinitcpio.conf", "/usr/lib/initcpio/hooks/darch",
+                             "/usr/lib/initcpio/install/darch"})
+
+
+def build_generation(config: Config, mount_root: Path, btrfs_root: Path):
     """
     Build a generation from config into the mounted filesystem.
 
     Expects:
     - mount_root: generation subvolume mounted here
+    - btrfs_root: top-level btrfs subvolume mounted here (see mount_btrfs_root)
     - @var NOT mounted (we mount it after moving pacman db)
     - Partitions already formatted, subvolumes already created
     """
     # Write config files before pacstrap so they exist for package install hooks
     print("\n=== Writing config files (pre-pacstrap) ===")
-    write_config_files(mount_root, config.files)
+    # Remember what we wrote, so the second pass only revisits files pacstrap touched
+    signatures: Dict[str, Tuple[FileEntry | SymlinkEntry, FileSignature | None]] = {}
+    write_config_files(mount_root, config.files, signatures)
 
     print("\n=== Installing base system with pacstrap ===")
     # Bind-mount host's package cache so pacstrap reads/writes there.
     # On non-darch host: uses host cache. On darch system: uses @var cache.
     gen_cache = mount_root / "var" / "cache" / "pacman" / "pkg"
     gen_cache.mkdir(parents=True, exist_ok=True)
-    with mount(Path("/var/cache/pacman/pkg"), gen_cache, bind=True):
-        run(["pacstrap", "-K", mount_root] + sorted(config.packages))
+    with mount(Path("/var/cache/pacman/pkg"), gen_cache, bind=True), pacstrap_config() as pacman_conf:
+        run(["pacstrap", "-C", pacman_conf, "-K", mount_root, *config.sorted_packages()])
 
     print("\n=== Relocating pacman state to /pacman ===")
     pacman_src = mount_root / "var" / "lib" / "pacman"
     pacman_dst = mount_root / "pacman"
     if pacman_src.exists():
-        shutil.move(pacman_src, pacman_dst)
+        move_tree(pacman_src, pacman_dst)
         print(f"  Moved {pacman_src} -> {pacman_dst}")
 
     print("\n=== Creating /current -> . symlink (for build-time pacman access) ===")
@@ -826,82 +1065,85 @@ def build_generation(config: Config, mount_root: Path, btrfs_dev: Path):
 
     print("\n=== Removing /var from generation (will be @var mount point) ===")
     var_in_gen = mount_root / "var"
-    if var_in_gen.exists():
-        shutil.rmtree(var_in_gen)
-        print("  Removed /var from generation")
-    var_in_gen.mkdir(exist_ok=True)
-
-    print("\n=== Mounting @var and setting up pacman symlink ===")
-    with mount(btrfs_dev, var_in_gen, "subvol=@var"):
-        setup_var_pacman_symlink(var_in_gen)
-
-        # Apply config.files (locale.gen, mkinitcpio.conf, hooks needed by chroot commands)
-        print("\n=== Applying config files ===")
-        write_config_files(mount_root, config.files)
-
-        print("\n=== Configuring system ===")
-        chroot_run(mount_root, "hwclock", "--systohc")
-        chroot_run(mount_root, "locale-gen")
-        chroot_run(mount_root, "passwd", "-d", "root")
-        chroot_run(mount_root, "mkinitcpio", "-P")
-        chroot_run(mount_root, "grub-install",
-                   "--target=x86_64-efi", "--efi-directory=/efi",
-                   "--boot-directory=/efi", "--bootloader-id=GRUB", "--removable")
-
-        # Create tmpfiles.d overrides for darch layout
-        tmpfiles_dir = mount_root / "etc/tmpfiles.d"
-        tmpfiles_dir.mkdir(parents=True, exist_ok=True)
-
-        # Override mtab line to not use L+ (force recreate)
-        etc_conf = (mount_root / "usr/lib/tmpfiles.d/etc.conf").read_text()
-        etc_conf = etc_conf.replace("L+ /etc/mtab", "L /etc/mtab")
-        (tmpfiles_dir / "etc.conf").write_text(etc_conf)
-
-        # Remove /root directory entries (darch has /root as symlink)
-        provision_conf = (mount_root / "usr/lib/tmpfiles.d/provision.conf").read_text()
-        provision_conf = re.sub(r'^[df].*\s/root.*\n', '', provision_conf, flags=re.MULTILINE)
-        (tmpfiles_dir / "provision.conf").write_text(provision_conf)
-
-        print("\n=== Setting up /etc symlinks ===")
-        # Fix directory permissions (pacstrap/systemd may have changed them)
-        (mount_root / "var/lib/machines").chmod(0o755)
-
-        # resolv.conf: symlink to /run (systemd-resolved or NetworkManager will manage)
-        force_symlink(mount_root / "etc/resolv.conf", "/run/systemd/resolve/stub-resolv.conf")
-
-        # mtab: symlink to /proc/mounts (standard)
-        force_symlink(mount_root / "etc/mtab", "/proc/mounts")
-
-
-def build_incremental(diff: ConfigDiff, mount_root: Path, btrfs_dev: Path, upgrade: bool):
+    # Deletion of the old /var tree overlaps with the configuration steps below
+    with background_rmtree(var_in_gen):
+        var_in_gen.mkdir(exist_ok=True)
+
+        print("\n=== Mounting @var and setting up pacman symlink ===")
+        with mount_subvol(btrfs_root, "@var", var_in_gen):
+            setup_var_pacman_symlink(var_in_gen)
+
+            # Apply config.files (locale.gen, mkinitcpio.conf, hooks needed by chroot commands)
+            print("\n=== Applying config files ===")
+            write_config_files(mount_root, config.files, signatures)
+
+            print("\n=== Configuring system ===")
+            with chroot_session(mount_root) as chroot:
+                # Independent of each other; mkinitcpio and grub-install must follow
+                chroot_run_parallel(chroot, ["hwclock", "--systohc"], ["locale-gen"], ["passwd", "-d", "root"])
+                # Always run explicitly: pacman doesn't fail the transaction if its
+                # mkinitcpio hook fails, so pacstrap's initramfs can't be trusted
+                chroot("mkinitcpio", "-P")
+                chroot("grub-install",
+                       "--target=x86_64-efi", "--efi-directory=/efi",
+                       "--boot-directory=/efi", "--bootloader-id=GRUB", "--removable")
+
+            # Create tmpfiles.d overrides for darch layout
+            tmpfiles_dir = mount_root / "etc/tmpfiles.d"
+            tmpfiles_dir.mkdir(parents=True, exist_ok=True)
+
+            # Override mtab line to not use L+ (force recreate)
+            etc_conf = (mount_root / "usr/lib/tmpfiles.d/etc.conf").read_text()
+            etc_conf = etc_conf.replace("L+ /etc/mtab", "L /etc/mtab")
+            (tmpfiles_dir / "etc.conf").write_text(etc_conf)
+
+            # Remove /root directory entries (darch has /root as symlink)
+            provision_conf = (mount_root / "usr/lib/tmpfiles.d/provision.conf").read_text()
+            provision_conf = re.sub(r'^[df].*\s/root.*\n', '', provision_conf, flags=re.MULTILINE)
+            (tmpfiles_dir / "provision.conf").write_text(provision_conf)
+
+            print("\n=== Setting up /etc symlinks ===")
+            # Fix directory permissions (pacstrap/systemd may have changed them)
+            (mount_root / "var/lib/machines").chmod(0o755)
+
+            # resolv.conf: symlink to /run (systemd-resolved or NetworkManager will manage)
+            force_symlink(mount_root / "etc/resolv.conf", "/run/systemd/resolve/stub-resolv.conf")
+
+            # mtab: symlink to /proc/mounts (standard)
+            force_symlink(mount_root / "etc/mtab", "/proc/mounts")
+
+
+def build_incremental(diff: ConfigDiff, mount_root: Path, btrfs_root: Path, upgrade: bool):
     """
     Build a new generation incrementally from an existing one.
 
     Expects:
     - mount_root: NEW generation subvolume mounted here (snapshot of old)
+    - btrfs_root: top-level btrfs subvolume mounted here (see mount_btrfs_root)
     - @var NOT mounted (we mount it here)
     - upgrade: if True, also run pacman -Syu
     - diff: ConfigDiff between old and new config
     """
     # Generation already has /pacman_local and /current -> . from previous build
     # Mount @var so pacman can find its database via the symlink
-    with mount(btrfs_dev, mount_root / "var", "subvol=@var"):
-        # Package changes - sync database first if installing or upgrading
-        if diff.packages_to_install or upgrade:
-            print("\n=== Syncing package database ===")
-            chroot_run(mount_root, "pacman", "-Sy")
-
-        if diff.packages_to_remove:
-            print(f"\n=== Removing packages: {diff.packages_to_remove} ===")
-            chroot_run(mount_root, "pacman", "-Rns", "--noconfirm", *sorted(diff.packages_to_remove))
-
-        if diff.packages_to_install:
-            print(f"\n=== Installing packages: {diff.packages_to_install} ===")
-            chroot_run(mount_root, "pacman", "-S", "--noconfirm", *sorted(diff.packages_to_install))
-
-        if upgrade:
-            print("\n=== Upgrading system packages ===")
-            chroot_run(mount_root, "pacman", "-Su", "--noconfirm")
+    with mount_subvol(btrfs_root, "@var", mount_root / "var"):
+        # The package commands share one arch-chroot session (started only if needed).
+        # It is closed before files are written, so none of its mounts (e.g. the
+        # resolv.conf bind mount) are live over paths in the generation.
+        with chroot_session(mount_root) as chroot:
+            # Package changes: removal is its own pacman transaction, then database
+            # sync, installs and upgrade happen together in one -S[y][u]
+            if diff.packages_to_remove:
+                print(f"\n=== Removing packages: {diff.packages_to_remove} ===")
+                chroot("pacman", "-Rns", "--noconfirm", *sorted(diff.packages_to_remove))
+
+            if diff.packages_to_install or upgrade:
+                print("\n=== Syncing package database ===")
+                if diff.packages_to_install:
+                    print(f"\n=== Installing packages: {diff.packages_to_install} ===")
+                if upgrade:
+                    print("\n=== Upgrading system packages ===")
+                chroot("pacman", "-Syu" if upgrade else "-Sy", "--noconfirm", *sorted(diff.packages_to_install))
 
         # Apply changed files
         files_to_write = {**diff.files_to_add, **diff.files_to_update}
@@ -915,19 +1157,20 @@ def build_incremental(diff: ConfigDiff, mount_root: Path, btrfs_dev: Path, upgra
                 full_path.unlink()
                 print(f"  removed: {path}")
 
-        # Regenerate locale if locale.gen changed
-        if "/etc/locale.gen" in changed_files:
-            print("\n=== Regenerating locales ===")
-            chroot_run(mount_root, "locale-gen")
+        # Commands depending on the written files get a second session
+        with chroot_session(mount_root) as chroot:
+            # Regenerate locale if locale.gen changed
+            if "/etc/locale.gen" in changed_files:
+                print("\n=== Regenerating locales ===")
+                chroot("locale-gen")
 
-        # Check if initramfs needs regeneration
-        initramfs_paths = {"/etc/mkinitcpio.conf", "/usr/lib/initcpio/hooks/darch",
-                           "/usr/lib/initcpio/install/darch"}
-        needs_initramfs = bool(changed_files & initramfs_paths)
+            # Check if initramfs needs regeneration (package changes are covered by
+            # pacman's own mkinitcpio hook)
+            needs_initramfs = bool(changed_files & INITRAMFS_PATHS)
 
-        if needs_initramfs:
-            print("\n=== Regenerating initramfs ===")
-            chroot_run(mount_root, "mkinitcpio", "-P")
+            if needs_initramfs:
+                print("\n=== Regenerating initramfs ===")
+                chroot("mkinitcpio", "-P")
 
 
 def detect_darch_system() -> tuple[Path, Path] | None:
@@ -944,18 +1187,14 @@ def detect_darch_system() -> tuple[Path, Path] | None:
     if not target.startswith("images/gen-"):
         return None
 
-    # Parse /proc/mounts to find devices
+    # Find devices in the mount table
     btrfs_dev = None
     esp_dev = None
-    with open("/proc/mounts", encoding="utf-8") as f:
-        for line in f:
-            parts = line.split()
-            if len(parts) >= 3:
-                device, mountpoint, fstype = parts[0], parts[1], parts[2]
-                if mountpoint == "/images" and fstype == "btrfs":
-                    btrfs_dev = Path(device)
-                elif mountpoint == "/efi" and fstype == "vfat":
-                    esp_dev = Path(device)
+    for device, mountpoint, fstype in parse_mounts():
+        if mountpoint == "/images" and fstype == "btrfs":
+            btrfs_dev = Path(device)
+        elif mountpoint == "/efi" and fstype == "vfat":
+            esp_dev = Path(device)
 
     if btrfs_dev and esp_dev:
         return btrfs_dev, esp_dev
@@ -1001,26 +1240,30 @@ def lockfile():
 def cleanup_stale_loops(image_path: Path):
     """Detach any stale loop devices associated with this image (including deleted)."""
     image_name = image_path.name
-    result = run(["losetup", "-a"], capture_output=True)
-    mounts = run(["mount"], capture_output=True)
 
-    # Find all loop devices for this image
+    # Find all loop devices for this image (read from sysfs rather than running losetup -a;
+    # a deleted backing file shows up with a " (deleted)" suffix, which still matches)
     loop_devs = []
-    for line in result.strip().split('\n'):
-        if line and image_name in line:
-            loop_devs.append(line.split(':')[0])
-
-    # Collect all mounts from these loop devices
-    devices_to_unmount = []
-    for mount_line in mounts.split('\n'):
-        for loop_dev in loop_devs:
-            if mount_line.startswith(loop_dev):
-                devices_to_unmount.append(mount_line.split(' on ')[0])
-
-    # Unmount in reverse order (last mounted first) - mount output is in mount order
-    for device in reversed(devices_to_unmount):
-        print(f"  Unmounting: {device}")
-        run(["umount", "-l", device], check=False)
+    for backing_file in sorted(Path("/sys/block").glob("loop*/loop/backing_file")):
+        try:
+            if image_name in backing_file.read_text():
+                loop_devs.append(f"/dev/{backing_file.parts[3]}")
+        except FileNotFoundError:
+            pass  # detached meanwhile
+
+    # Collect all mounts from these loop devices (or their partitions)
+    mountpoints_to_unmount = []
+    if loop_devs:
+        for device, mountpoint, _fstype in parse_mounts():
+            if any(device == d or device.startswith(f"{d}p") for d in loop_devs):
+                mountpoints_to_unmount.append(mountpoint)
+
+    # Unmount in reverse order (last mounted first) - the mount table is in mount order
+    for mountpoint in reversed(mountpoints_to_unmount):
+        print(f"  Unmounting: {mountpoint}")
+        run(["umount", "-l", mountpoint], check=False)
+    if mountpoints_to_unmount:
+        invalidate_mounts()
 
     # Detach loop devices
     for loop_dev in loop_devs:
@@ -1037,16 +1280,95 @@ def loop_device(image_path: Path) -> Iterator[Tuple[Path, Path]]:
     try:
         yield Path(f"{loop}p1"), Path(f"{loop}p2")  # esp, btrfs
     finally:
-        run(["sync"])
+        syncfs(image_path)
         run(["losetup", "-d", loop], check=False)
 
 
+@contextmanager
+def chroot_session(root: Path) -> Iterator[Callable[..., None]]:
+    """Run several commands in one arch-chroot, so its API mounts are set up only once.
+
+    Yields a function taking a command (like chroot_run) which raises CalledProcessError
+    on failure. The chroot shell is started on first use. Commands are fed to the shell
+    over stdin (their own stdin is /dev/null), and each exit status is reported back on
+    a separate pipe so the commands' output can go straight to the terminal.
+    """
+    proc: subprocess.Popen | None = None
+    status_r = status_w = -1  # status_w is only open in the shell (same fd number)
+
+    def run_in_chroot(*cmd):
+        nonlocal proc, status_r, status_w
+        if proc is None:
+            status_r, status_w = os.pipe()
+            try:
+                proc = subprocess.Popen(["arch-chroot", root, "/bin/sh"], stdin=subprocess.PIPE,
+                                        pass_fds=(status_w,), env=clean_env(), text=True)
+            finally:
+                os.close(status_w)  # So reads see EOF if the shell dies
+        assert proc.stdin is not None
+        cmd_str = shlex.join(str(c) for c in cmd)
+        try:
+            proc.stdin.write(f"{cmd_str} </dev/null; echo $? >&{status_w}\n")
+            proc.stdin.flush()
+        except BrokenPipeError:  # Shell already exited
+            raise subprocess.CalledProcessError(proc.wait(), cmd) from None
+        status = b""
+        while not status.endswith(b"\n"):
+            chunk = os.read(status_r, 16)
+            if not chunk:  # Shell exited
+                raise subprocess.CalledProcessError(proc.wait(), cmd)
+            status += chunk
+        if int(status) != 0:
+            raise subprocess.CalledProcessError(int(status), cmd)
+
+    try:
+        yield run_in_chroot
+    finally:
+        if proc is not None:
+            assert proc.stdin is not None
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # Shell already exited (reported by run_in_chroot)
+            proc.wait()
+            os.close(status_r)
+
+
+@contextmanager
+def background_rmtree(path: Path) -> Iterator[None]:
+    """Move path aside and delete it in a background thread, waiting for it on exit."""
+    if not path.exists():
+        yield
+        return
+    trash = path.with_name(f".{path.name}.deleting")
+    os.rename(path, trash)
+    errors: list[BaseException] = []
+
+    def delete():
+        try:
+            shutil.rmtree(trash)
+        except BaseException as exc:  # pylint: disable=broad-exception-caught
+            errors.append(exc)  # Re-raised in the caller's thread
+
+    thread = threading.Thread(target=delete, daemon=True)
+    thread.start()
+    print(f"  Removed {path} (deleting in background)")
+    try:
+        yield
+    finally:
+        thread.join()
+    # Only reached if the body succeeded, so an error in the body isn't masked
+    if errors:
+        raise errors[0]
+
+
 @contextmanager
 def mount(device: Path, mount_point: Path, options: str | None = None, bind: bool = False) -> Iterator[Path]:
     """Mount a filesystem, yield mount point as Path."""
     mount_point.mkdir(parents=True, exist_ok=True)
     # Ensure not already mounted from a previous failed run
-    run(["umount", "-q", mount_point], check=False)
+    if any(mp == str(mount_point) for _dev, mp, _fstype in parse_mounts()):
+        run(["umount", "-q", mount_point], check=False)
     cmd: list[str | Path] = ["mount"]
     if bind:
         cmd.append("--bind")
@@ -1054,12 +1376,34 @@ def mount(device: Path, mount_point: Path, options: str | None = None, bind: boo
         cmd.extend(["-o", options])
     cmd.extend([device, mount_point])
     run(cmd)
+    invalidate_mounts()
     try:
         yield mount_point
     finally:
         # Sync to flush writes, then unmount properly
-        run(["sync"])
+        syncfs(mount_point)
         run(["umount", mount_point], check=False)
+        invalidate_mounts()
+
+
+@contextmanager
+def mount_btrfs_root(btrfs_dev: Path) -> Iterator[Path]:
+    """Mount the top-level btrfs subvolume (containing @images, @var, @home).
+
+    The filesystem is mounted once; subvolumes are then bind-mounted from it
+    with mount_subvol(), which is a VFS-only operation.
+    """
+    with mount(btrfs_dev, Path("/mnt/darch-btrfs"), "subvolid=5") as btrfs_root:
+        # On systemd hosts / is shared, and so would this mount be. Binds taken from
+        # a shared mount join its peer group, so anything later mounted under them
+        # (efi, @var, chroot API mounts) would be replicated into @images here.
+        run(["mount", "--make-private", btrfs_root])
+        yield btrfs_root
+
+
+def mount_subvol(btrfs_root: Path, subvol: str, mount_point: Path) -> AbstractContextManager[Path]:
+    """Bind-mount a subvolume (e.g. "@var") from the mounted top-level subvolume."""
+    return mount(btrfs_root / subvol, mount_point, bind=True)
 
 
 @contextmanager
@@ -1075,9 +1419,12 @@ def open_image_file(image_path: Path, image_size: str | None) -> Iterator[Tuple[
         run(["truncate", "-s", image_size, image_path])
 
         print("\n=== Partitioning disk ===")
-        run(["sgdisk", "-Z", image_path])
-        run(["sgdisk", "-n", "1:0:+512M", "-t", "1:ef00", image_path])  # ESP
-        run(["sgdisk", "-n", "2:0:0", "-t", "2:8300", image_path])       # btrfs
+        # sgdisk applies stacked options in order, so one call does it all. -o (fresh
+        # GPT) rather than -Z, which exits after zapping; the file is new and zeroed anyway.
+        run(["sgdisk", "-o",
+             "-n", "1:0:+512M", "-t", "1:ef00",  # ESP
+             "-n", "2:0:0", "-t", "2:8300",      # btrfs
+             image_path])
 
         print("\n=== Setting up loop device ===")
         with loop_device(image_path) as (esp_part, root_part):
@@ -1089,15 +1436,16 @@ def open_image_file(image_path: Path, image_size: str | None) -> Iterator[Tuple[
             mount_point = Path("/mnt/darch-setup")
             mount_point.mkdir(parents=True, exist_ok=True)
             run(["mount", root_part, mount_point])
+            invalidate_mounts()
 
-            run(["btrfs", "subvol", "create", mount_point / "@images"])
-            run(["btrfs", "subvol", "create", mount_point / "@var"])
-            run(["btrfs", "subvol", "create", mount_point / "@home"])
+            run(["btrfs", "subvol", "create",
+                 mount_point / "@images", mount_point / "@var", mount_point / "@home"])
 
             (mount_point / "@home/root").mkdir(mode=0o700, parents=True, exist_ok=True)
             (mount_point / "@var/lib/machines").mkdir(parents=True, exist_ok=True)
 
             run(["umount", mount_point])
+            invalidate_mounts()
             fix_owner(image_path)
             print("\n=== Image created successfully ===")
             yield esp_part, root_part
@@ -1107,34 +1455,52 @@ def open_image_file(image_path: Path, image_size: str | None) -> Iterator[Tuple[
 # Operations on mounted filesystems
 # =============================================================================
 
+GEN_DIR_RE = re.compile(r"gen-(\d+)\Z", re.ASCII)
+
+
 def get_generations(images: Path) -> list[GenerationInfo]:
     """Get all generations from mounted @images, sorted by gen number.
 
     Returns both complete and incomplete generations. Use the `complete` field
     to filter as needed.
     """
-    result = []
-    for p in images.glob("gen-*"):
-        if not p.name[4:].isdigit():
-            continue
-        gen = int(p.name[4:])
-        config_path = p / "config.json"
-        build_info = None
-        if config_path.exists():
-            created_at = config_path.stat().st_ctime
-            complete = True
-            # Load build info if present
-            build_info_path = p / "build-info.json"
-            if build_info_path.exists():
-                build_info = BuildInfo.from_dict(json.loads(build_info_path.read_text()))
-        else:
-            created_at = None
-            complete = False
-        result.append(GenerationInfo(gen=gen, path=p, complete=complete, created_at=created_at, build_info=build_info))
-    return sorted(result, key=lambda g: g.gen)
+    dirs: list[tuple[int, str]] = []
+    with os.scandir(images) as it:
+        for entry in it:
+            # DirEntry.is_dir() uses the type from readdir, no extra stat
+            m = GEN_DIR_RE.match(entry.name)
+            if m is not None and entry.is_dir(follow_symlinks=False):
+                dirs.append((int(m.group(1)), entry.path))
+    dirs.sort(key=itemgetter(0))
+
+    # Reading metadata is blocking I/O per generation; overlap it when there are many
+    if len(dirs) > 4:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(lambda d: _read_generation(*d), dirs))
+    return [_read_generation(gen, path) for gen, path in dirs]
+
+
+def _read_generation(gen: int, path: str) -> GenerationInfo:
+    """Read the metadata of one generation directory (for get_generations)."""
+    # Plain string paths here: cheaper than building Path objects
+    build_info = None
+    try:
+        created_at = os.stat(f"{path}/config.json").st_ctime
+        complete = True
+    except FileNotFoundError:
+        created_at = None
+        complete = False
+    if complete:
+        # Load build info if present
+        try:
+            with open(f"{path}/build-info.json", "rb") as f:
+                build_info = BuildInfo.from_dict(json.load(f))
+        except FileNotFoundError:
+            pass
+    return GenerationInfo(gen=gen, path=Path(path), complete=complete, created_at=created_at, build_info=build_info)
 
 
-def garbage_collect_generations(images: Path):
+def garbage_collect_generations(images: Path) -> list[GenerationInfo]:
     """Delete incomplete and old generations based on GC settings.
 
     Policy:
@@ -1144,62 +1510,76 @@ def garbage_collect_generations(images: Path):
     - Delete oldest if count exceeds GC_KEEP_MAX (and old enough)
     - Delete generations older than GC_MAX_AGE_DAYS (if above GC_KEEP_MIN)
 
-    Returns list of deleted generation numbers.
+    Returns the remaining generations, sorted by gen number.
     """
     now = time.time()
     gens = get_generations(images)
+    to_delete = []
 
     # First pass: delete all incomplete generations
     for g in gens:
         if not g.complete:
             print(f"Deleting incomplete gen-{g.gen}")
-            run(["btrfs", "subvol", "delete", g.path])
+            to_delete.append(g.path)
 
-    # Second pass: GC old complete generations
+    # Second pass: GC old complete generations (gens is sorted by gen number, oldest first).
+    # Skip the scan entirely unless some generation can exceed the count or age limits.
     complete = [g for g in gens if g.complete]
-    if len(complete) <= GC_KEEP_MIN:
-        return
+    over_count = GC_KEEP_MAX > 0 and len(complete) > GC_KEEP_MAX
+    oldest = min((g.created_at for g in complete if g.created_at is not None), default=None)
+    over_age = GC_MAX_AGE_DAYS > 0 and oldest is not None and (now - oldest) / 86400 > GC_MAX_AGE_DAYS
+    if len(complete) > GC_KEEP_MIN and (over_count or over_age):
+        complete_deleted = 0
+
+        for g in complete:
+            if not g.complete or g.created_at is None:
+                continue
+            remaining = len(complete) - complete_deleted
 
-    # Sort by gen number (oldest first) for deletion candidates
-    complete_sorted = sorted(complete, key=lambda g: g.gen)
-    complete_deleted = 0
+            # Stop if we're at minimum
+            if remaining <= GC_KEEP_MIN:
+                break
 
-    for g in complete_sorted:
-        if not g.complete or g.created_at is None:
-            continue
-        remaining = len(complete) - complete_deleted
+            age_days = (now - g.created_at) / 86400
 
-        # Stop if we're at minimum
-        if remaining <= GC_KEEP_MIN:
-            break
+            # Never delete generations younger than min age
+            if age_days < GC_MIN_AGE_DAYS:
+                continue
 
-        age_days = (now - g.created_at) / 86400
+            # Delete if over max age
+            if GC_MAX_AGE_DAYS > 0 and age_days > GC_MAX_AGE_DAYS:
+                print(f"Deleting old gen-{g.gen} (age: {age_days:.0f} days)")
+                to_delete.append(g.path)
+                complete_deleted += 1
+                continue
 
-        # Never delete generations younger than min age
-        if age_days < GC_MIN_AGE_DAYS:
-            continue
+            # Delete if over max count
+            if GC_KEEP_MAX > 0 and remaining > GC_KEEP_MAX:
+                print(f"Deleting excess gen-{g.gen} (count: {remaining} > {GC_KEEP_MAX})")
+                to_delete.append(g.path)
+                complete_deleted += 1
 
-        # Delete if over max age
-        if GC_MAX_AGE_DAYS > 0 and age_days > GC_MAX_AGE_DAYS:
-            print(f"Deleting old gen-{g.gen} (age: {age_days:.0f} days)")
-            run(["btrfs", "subvol", "delete", g.path])
-            complete_deleted += 1
-            continue
+    delete_gen_subvols(to_delete)
+    deleted = set(to_delete)
+    return [g for g in gens if g.path not in deleted]
 
-        # Delete if over max count
-        if GC_KEEP_MAX > 0 and remaining > GC_KEEP_MAX:
-            print(f"Deleting excess gen-{g.gen} (count: {remaining} > {GC_KEEP_MAX})")
-            run(["btrfs", "subvol", "delete", g.path])
-            complete_deleted += 1
+
+def delete_gen_subvols(paths: list[Path]):
+    """Delete generation subvolumes with one btrfs invocation."""
+    if not paths:
+        return
+    run(["btrfs", "subvol", "delete", "--commit-after", *paths])
 
 
 def create_gen_subvol(images: Path, gen: int, snapshot_from: int | None = None):
     """Create a generation subvolume in mounted @images."""
     target = images / f"gen-{gen}"
-    # Delete existing subvolume if present (e.g., from failed build)
-    if target.exists():
+    # Delete existing subvolume if present (e.g., from failed build). This check
+    # can't be replaced by a blind delete-and-ignore-failure: if target existed as
+    # a plain directory, `btrfs subvol snapshot` would nest the snapshot inside it.
+    if os.path.lexists(target):
         print(f"Deleting existing gen-{gen}")
-        run(["btrfs", "subvol", "delete", target])
+        delete_gen_subvols([target])
     if snapshot_from is not None:
         source = images / f"gen-{snapshot_from}"
         print(f"Creating gen-{gen} as snapshot of gen-{snapshot_from}")
@@ -1209,9 +1589,15 @@ def create_gen_subvol(images: Path, gen: int, snapshot_from: int | None = None):
         run(["btrfs", "subvol", "create", target])
 
 
+def save_gen_config(gen_path: Path, config: Config):
+    """Save config.json (the completion marker) to a generation."""
+    atomic_write_text(gen_path / "config.json", config.to_json())
+
+
 def load_gen_config(gen_path: Path) -> Config:
     """Load config.json from mounted generation."""
-    return Config.from_json((gen_path / "config.json").read_text())
+    with open(gen_path / "config.json", "rb") as f:
+        return Config.from_dict(json.load(f))
 
 
 def load_config_module(config_path: Path) -> Config:
@@ -1268,18 +1654,29 @@ def resolve_system(
     return (esp_dev, btrfs_dev, on_darch)
 
 
-def get_partition_uuid(partition_dev: Path) -> str:
-    """Get UUID of given partition."""
-    return run(["blkid", "-s", "UUID", "-o", "value", partition_dev], capture_output=True)
+def get_partition_uuids(*partition_devs: Path) -> list[str]:
+    """Get UUIDs of the given partitions (in order) with a single blkid call."""
+    output = run(["blkid", "-s", "UUID", "-o", "export", *partition_devs], capture_output=True)
+    # Output is one KEY=value block per device, separated by blank lines
+    uuids: dict[str, str] = {}
+    for block in output.split("\n\n"):
+        tags = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        if "DEVNAME" in tags:
+            uuids[os.path.realpath(tags["DEVNAME"])] = tags.get("UUID", "")
+    return [uuids.get(os.path.realpath(dev), "") for dev in partition_devs]
 
 
-def compute_generation_changes(config: Config, btrfs_dev: Path, gen: int, upgrade: bool) -> Tuple[ConfigDiff, list[str]]:
-    """Mount specified generation and diff config against given diff, as well as check for package upgrades (if upgrade==True)"""
-    with mount(btrfs_dev, Path("/mnt/darch-old"), f"subvol=@images/gen-{gen}") as old_gen:
-        old_config = load_gen_config(old_gen)
-        diff = ConfigDiff.compute(old_config, config)
-        upgrades = get_available_upgrades(old_gen) if upgrade else []
-        return (diff, upgrades)
+def compute_generation_changes(config: Config, images: Path, gen: int, upgrade: bool) -> Tuple[ConfigDiff, list[str]]:
+    """Diff config against specified generation, as well as check for package upgrades (if upgrade==True)"""
+    # The generation is readable through the mounted @images, no need to mount it separately
+    old_config = load_gen_config(images / f"gen-{gen}")
+    diff = ConfigDiff.compute(old_config, config)
+    upgrades = []
+    if upgrade:
+        # arch-chroot expects its root to be a mountpoint
+        with mount(images / f"gen-{gen}", Path("/mnt/darch-old"), bind=True) as old_gen:
+            upgrades = get_available_upgrades(old_gen)
+    return (diff, upgrades)
 
 
 def apply_configuration(
@@ -1309,25 +1706,24 @@ def apply_configuration(
             image_size=image_size,
         )
 
-        images = stack.enter_context(mount(btrfs_dev, Path("/mnt/darch-images"), "subvol=@images"))
+        btrfs_root = stack.enter_context(mount_btrfs_root(btrfs_dev))
+        images = btrfs_root / "@images"
 
         # Clean up incomplete generations from failed builds
-        garbage_collect_generations(images)
+        complete_gens = [g for g in garbage_collect_generations(images) if g.complete]
 
         # Find current complete generation
-        complete_gens = [g for g in get_generations(images) if g.complete]
         current = complete_gens[-1].gen if complete_gens else None
         new_gen = (current or 0) + 1
 
         # Get UUIDs and add runtime-dependent files before diffing
-        esp_uuid = get_partition_uuid(esp_dev)
-        root_uuid = get_partition_uuid(btrfs_dev)
+        esp_uuid, root_uuid = get_partition_uuids(esp_dev, btrfs_dev)
         config.add_file("/etc/fstab", generate_fstab(esp_uuid, root_uuid))
 
         fresh = current is None or rebuild
         diff = None
         if not fresh:
-            diff, upgrades = compute_generation_changes(config=config, btrfs_dev=btrfs_dev, gen=current, upgrade=upgrade)
+            diff, upgrades = compute_generation_changes(config=config, images=images, gen=current, upgrade=upgrade)
             if not diff.has_changes() and not upgrades:
                 print("Already up to date.")
                 return
@@ -1335,7 +1731,7 @@ def apply_configuration(
             # If only user home files changed, update them without creating a new generation
             if not diff.needs_new_generation() and not upgrades and diff.user_files_changed:
                 print("=== Updating user home files (no new generation needed) ===")
-                with mount(btrfs_dev, Path("/mnt/darch-home"), "subvol=@home") as home_mount:
+                with mount_subvol(btrfs_root, "@home", Path("/mnt/darch-home")) as home_mount:
                     write_user_home_files(config.users, home_mount)
                 print("=== SUCCESS: Updated user home files ===")
                 return
@@ -1343,7 +1739,7 @@ def apply_configuration(
         # Create and mount new generation
         create_gen_subvol(images, new_gen, snapshot_from=None if fresh else current)
         mount_root = Path("/mnt/darch-build")
-        stack.enter_context(mount(btrfs_dev, mount_root, f"subvol=@images/gen-{new_gen}"))
+        stack.enter_context(mount_subvol(btrfs_root, f"@images/gen-{new_gen}", mount_root))
         stack.enter_context(mount(esp_dev, mount_root / "efi"))
         # Note: @var is mounted by builder functions, not here
 
@@ -1351,20 +1747,21 @@ def apply_configuration(
             build_generation(
                 config=config,
                 mount_root=mount_root,
-                btrfs_dev=btrfs_dev,
+                btrfs_root=btrfs_root,
             )
         else:
             # For incremental builds, invalidate inherited config.json so a failed
             # build is clearly incomplete. Rename to .prev for debugging.
-            old_config_file = mount_root / "config.json"
-            if old_config_file.exists():
-                old_config_file.rename(mount_root / "config.json.prev")
+            try:
+                os.replace(mount_root / "config.json", mount_root / "config.json.prev")
+            except FileNotFoundError:
+                pass
 
             assert diff is not None
             build_incremental(
                 diff,
                 mount_root=mount_root,
-                btrfs_dev=btrfs_dev,
+                btrfs_root=btrfs_root,
                 upgrade=upgrade,
             )
 
@@ -1373,21 +1770,28 @@ def apply_configuration(
             print(f"\n=== Configuring users: {[u.name for u in config.users]} ===")
             home_mount = mount_root / "home"
             home_mount.mkdir(exist_ok=True)
-            with mount(btrfs_dev, home_mount, "subvol=@home"):
+            with mount_subvol(btrfs_root, "@home", home_mount):
                 configure_users(config.users, mount_root, home_mount)
 
         # Save config and build info
         print("\n=== Saving config ===")
-        (mount_root / "config.json").write_text(config.to_json())
+        # build-info.json first: config.json marks the generation complete, so it goes last
         build_info = BuildInfo(fresh=fresh, package_count=count_packages(mount_root))
-        (mount_root / "build-info.json").write_text(json.dumps(build_info.to_dict()))
+        atomic_write_text(mount_root / "build-info.json", json.dumps(build_info.to_dict()))
+        save_gen_config(mount_root, config)
 
-        # Write GRUB config with all complete generations
+        # Write GRUB config with all complete generations (the surviving ones plus the new one)
         print("\n=== Writing GRUB config ===")
-        complete_gens = [g for g in get_generations(images) if g.complete]
+        complete_gens.append(GenerationInfo(
+            gen=new_gen,
+            path=images / f"gen-{new_gen}",
+            complete=True,
+            created_at=(mount_root / "config.json").stat().st_ctime,
+            build_info=build_info,
+        ))
         grub_cfg = mount_root / "efi" / "grub" / "grub.cfg"
         grub_cfg.parent.mkdir(parents=True, exist_ok=True)
-        grub_cfg.write_text(generate_grub_config(root_uuid, complete_gens))
+        atomic_write_text(grub_cfg, generate_grub_config(root_uuid, complete_gens))
 
         print(f"\n=== SUCCESS: Built gen-{new_gen} ===")
 
@@ -1422,28 +1826,27 @@ def check_configuration(
             image_path=image_path,
         )
 
-        images = stack.enter_context(mount(btrfs_dev, Path("/mnt/darch-images"), "subvol=@images"))
+        btrfs_root = stack.enter_context(mount_btrfs_root(btrfs_dev))
+        images = btrfs_root / "@images"
 
         # Find current complete generation
         complete_gens = [g for g in get_generations(images) if g.complete]
         if not complete_gens:
             print("No existing generations. A fresh build would be performed.")
-            print(f"\nPackages to install ({len(config.packages)}):")
-            for pkg in sorted(config.packages):
-                print(f"  + {pkg}")
-            print(f"\nFiles to create ({len(config.files)}):")
-            for path in sorted(config.files):
-                print(f"  + {path}")
+            # One write per list rather than one print per line
+            sys.stdout.write(f"\nPackages to install ({len(config.packages)}):\n"
+                             + "".join(f"  + {pkg}\n" for pkg in config.sorted_packages()))
+            sys.stdout.write(f"\nFiles to create ({len(config.files)}):\n"
+                             + "".join(f"  + {path}\n" for path in sorted(config.files)))
             return
         current = complete_gens[-1]
 
         # Add runtime-dependent files before diffing
-        esp_uuid = get_partition_uuid(esp_dev)
-        root_uuid = get_partition_uuid(btrfs_dev)
+        esp_uuid, root_uuid = get_partition_uuids(esp_dev, btrfs_dev)
         config.add_file("/etc/fstab", generate_fstab(esp_uuid, root_uuid))
 
         # Load old config and compute diff
-        diff, upgrades = compute_generation_changes(config=config, btrfs_dev=btrfs_dev, gen=current.gen, upgrade=upgrade)
+        diff, upgrades = compute_generation_changes(config=config, images=images, gen=current.gen, upgrade=upgrade)
         diff.print_summary()
 
         if upgrade:
@@ -1463,16 +1866,21 @@ def check_configuration(
 
 
 
+@functools.lru_cache(maxsize=1)
 def find_ovmf() -> tuple[Path, Path] | None:
-    """Find OVMF firmware files for UEFI boot."""
+    """Find OVMF firmware files for UEFI boot (cached after the first lookup)."""
     ovmf_paths = [
         ("/usr/share/edk2-ovmf/x64/OVMF_CODE.4m.fd", "/usr/share/edk2-ovmf/x64/OVMF_VARS.4m.fd"),
         ("/usr/share/edk2-ovmf/x64/OVMF_CODE.fd", "/usr/share/edk2-ovmf/x64/OVMF_VARS.fd"),
         ("/usr/share/OVMF/OVMF_CODE.fd", "/usr/share/OVMF/OVMF_VARS.fd"),
     ]
     for code_file, vars_file in ovmf_paths:
-        if Path(code_file).exists() and Path(vars_file).exists():
-            return Path(code_file), Path(vars_file)
+        try:
+            os.stat(code_file)
+            os.stat(vars_file)
+        except OSError:
+            continue
+        return Path(code_file), Path(vars_file)
     return None
 
 
@@ -1498,10 +1906,12 @@ def test_image(
     print(f"OVMF: {ovmf_code}")
     print(f"Mode: {'graphics' if graphics else 'serial console'}")
 
-    # Create a temporary copy of OVMF_VARS (it's writable)
-    vars_copy = tempfile.NamedTemporaryFile(delete=False)
-    vars_copy.write(ovmf_vars.read_bytes())
+    # Create a temporary copy of OVMF_VARS (it's writable). Kept on tmpfs when
+    # available; copyfile lets the kernel copy the data (copy_file_range/sendfile).
+    shm = Path("/dev/shm")
+    vars_copy = tempfile.NamedTemporaryFile(delete=False, dir=shm if shm.is_dir() else None)
     vars_copy.close()
+    shutil.copyfile(ovmf_vars, vars_copy.name)
 
     cmd = [
         "qemu-system-x86_64",
@@ -1558,31 +1968,38 @@ def main():
             return None
         return Path(value)
 
+    # Only build the subparser for the requested command; all of them for help/errors
+    requested = sys.argv[1] if len(sys.argv) > 1 else None
+    build_all = requested not in ("apply", "test", "check")
+
     # apply command
-    p_apply = subparsers.add_parser("apply", help="Apply configuration (auto-detects fresh vs incremental)")
-    p_apply.add_argument("--config", default="./config.py", help="Path to config.py", type=path_type)
-    p_apply.add_argument("--image", help="Path to disk image", type=path_type)
-    p_apply.add_argument("--size", default="10G", help="Image size (default: 10G)")
-    p_apply.add_argument("--btrfs", help="Btrfs device (e.g., /dev/nvme0n1p2)", type=path_type)
-    p_apply.add_argument("--esp", help="ESP device (e.g., /dev/nvme0n1p1)", type=path_type)
-    p_apply.add_argument("--upgrade", action="store_true", help="Also upgrade all packages (pacman -Syu)")
-    p_apply.add_argument("--rebuild", action="store_true", help="Force fresh build even if generations exist")
-    p_apply.add_argument("--switch", action="store_true", help="Switch to new generation after build (on darch systems)")
+    if build_all or requested == "apply":
+        p_apply = subparsers.add_parser("apply", help="Apply configuration (auto-detects fresh vs incremental)")
+        p_apply.add_argument("--config", default="./config.py", help="Path to config.py", type=path_type)
+        p_apply.add_argument("--image", help="Path to disk image", type=path_type)
+        p_apply.add_argument("--size", default="10G", help="Image size (default: 10G)")
+        p_apply.add_argument("--btrfs", help="Btrfs device (e.g., /dev/nvme0n1p2)", type=path_type)
+        p_apply.add_argument("--esp", help="ESP device (e.g., /dev/nvme0n1p1)", type=path_type)
+        p_apply.add_argument("--upgrade", action="store_true", help="Also upgrade all packages (pacman -Syu)")
+        p_apply.add_argument("--rebuild", action="store_true", help="Force fresh build even if generations exist")
+        p_apply.add_argument("--switch", action="store_true", help="Switch to new generation after build (on darch systems)")
 
     # test command
-    p_test = subparsers.add_parser("test", help="Boot an image in QEMU for testing")
-    p_test.add_argument("image", help="Path to disk image", type=path_type)
-    p_test.add_argument("--memory", default="4G", help="VM memory (default: 4G)")
-    p_test.add_argument("--cpus", type=int, default=2, help="Number of CPUs (default: 2)")
-    p_test.add_argument("--graphics", action="store_true", help="Enable graphical display (virtio-gpu)")
+    if build_all or requested == "test":
+        p_test = subparsers.add_parser("test", help="Boot an image in QEMU for testing")
+        p_test.add_argument("image", help="Path to disk image", type=path_type)
+        p_test.add_argument("--memory", default="4G", help="VM memory (default: 4G)")
+        p_test.add_argument("--cpus", type=int, default=2, help="Number of CPUs (default: 2)")
+        p_test.add_argument("--graphics", action="store_true", help="Enable graphical display (virtio-gpu)")
 
     # check command
-    p_check = subparsers.add_parser("check", help="Check what would change without building (dry-run)")
-    p_check.add_argument("--config", default="./config.py", help="Path to config.py", type=path_type)
-    p_check.add_argument("--image", help="Path to disk image", type=path_type)
-    p_check.add_argument("--btrfs", help="Btrfs device (e.g., /dev/nvme0n1p2)", type=path_type)
-    p_check.add_argument("--esp", help="ESP device (e.g., /dev/nvme0n1p1)", type=path_type)
-    p_check.add_argument("--upgrade", action="store_true", help="Also check for package upgrades")
+    if build_all or requested == "check":
+        p_check = subparsers.add_parser("check", help="Check what would change without building (dry-run)")
+        p_check.add_argument("--config", default="./config.py", help="Path to config.py", type=path_type)
+        p_check.add_argument("--image", help="Path to disk image", type=path_type)
+        p_check.add_argument("--btrfs", help="Btrfs device (e.g., /dev/nvme0n1p2)", type=path_type)
+        p_check.add_argument("--esp", help="ESP device (e.g., /dev/nvme0n1p1)", type=path_type)
+        p_check.add_argument("--upgrade", action="store_true", help="Also check for package upgrades")
 
     args = parser.parse_args()
 